@@ -1,52 +1,199 @@
-import xml.etree.ElementTree as ET
-from collections import defaultdict
+from lxml import etree
+import io
+from collections import namedtuple
+from operator import itemgetter
 import aiohttp
 import asyncio
 from tqdm.asyncio import tqdm_asyncio
 from datetime import datetime
 import gzip
-import shutil
-from xml.dom import minidom
-import re
+import concurrent.futures
+import multiprocessing
 from opencc import OpenCC
 import os
-from tqdm import tqdm
 import hashlib
+import functools
+import itertools
+import heapq
+import contextlib
+import pickle
+import json
+import time
 
 # 预初始化 OpenCC 转换器，避免重复创建对象带来的开销
 cc = OpenCC('t2s')
 
+@functools.lru_cache(maxsize=200_000)
+def _convert(string):
+    """带缓存的简繁体转换，频道ID等重复字符串只转换一次"""
+    return cc.convert(string)
+
 def transform2_zh_hans(string):
     """安全的简繁体转换函数，增加空值检查"""
     if string is None:
         return None
-    if not isinstance(string, str):
-        print(f"Warning: Expected string for conversion, got {type(string)}. Returning original value.")
-        return string
     try:
-        return cc.convert(string)
+        return _convert(string)
     except Exception as e:
         print(f"Convert to zh_hans failed: {e}. Input was: '{string}'")
         return string
 
-def get_content_hash(epg_content):
-    """生成EPG内容的哈希值，用于缓存标识"""
-    return hashlib.md5(epg_content.encode('utf-8')).hexdigest()
+def get_content_hash(epg_bytes):
+    """生成EPG内容的哈希值（8字节摘要），用于缓存标识"""
+    return hashlib.blake2b(epg_bytes, digest_size=8).digest()
+
+# 单个EPG源中待转换的文本数超过该值时，使用多进程并行转换
+PARALLEL_CONVERT_THRESHOLD = 10_000
+
+# 时间字符串中需要清理的空白字符
+_WS = str.maketrans('', '', ' \t\r\n')
+
+# XML 1.0 不允许出现的控制字符；recover 模式下lxml会把它们原样放进文本，写出时会报错
+_INVALID_XML_CHARS = str.maketrans('', '', ''.join(
+    chr(c) for c in itertools.chain(range(0x00, 0x09), (0x0b, 0x0c), range(0x0e, 0x20))
+))
+
+def _clean_text(text):
+    """去除XML不允许的控制字符，空值原样返回"""
+    if text is None:
+        return None
+    return text.translate(_INVALID_XML_CHARS)
+
+# 节目信息只保留需要输出的字段，避免在解析阶段创建XML元素
+Prog = namedtuple('Prog', 'start stop title desc')
+
+# 所有请求共用的HTTP头；Accept-Encoding 由aiohttp按已安装的解压库（如brotli）自动设置
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36",
+}
 
 # 简单的内存缓存字典
 epg_cache = {}
 
-async def fetch_epg(url):
-    """获取EPG数据的异步函数"""
-    connector = aiohttp.TCPConnector(limit=16, ssl=False)
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36"
-    }
+# 磁盘缓存目录，跨次运行保存解析结果；超过有效期未被使用的缓存会被清理
+CACHE_DIR = 'cache'
+CACHE_MAX_AGE = 7 * 24 * 3600
+
+# 解析结果的格式变化时递增，避免读取旧格式的缓存
+CACHE_VERSION = 3
+
+def _cache_path(content_hash):
+    return os.path.join(CACHE_DIR, f"{content_hash.hex()}.v{CACHE_VERSION}.pkl")
+
+def load_cached_parse(content_hash):
+    """从磁盘缓存读取解析结果，不存在或读取失败时返回None，读取失败的缓存会被删除"""
+    path = _cache_path(content_hash)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            result = pickle.load(f)
+        # 更新修改时间，标记该缓存仍在使用
+        os.utime(path)
+        return result
+    except Exception as e:
+        print(f"读取缓存 {path} 失败: {e}")
+        # 删除损坏的缓存，之后不再基于它发送条件请求
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+def save_cached_parse(content_hash, result):
+    """将解析结果写入磁盘缓存"""
+    path = _cache_path(content_hash)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f, protocol=5)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"写入缓存 {path} 失败: {e}")
+
+# 各URL上次响应的ETag/Last-Modified及内容哈希，用于条件请求
+HTTP_META_FILE = os.path.join(CACHE_DIR, 'http_meta.json')
+
+# fetch_epg在源返回304时使用的标记值
+NOT_MODIFIED = object()
+
+def load_http_meta():
+    """读取条件请求所需的元数据"""
+    if not os.path.exists(HTTP_META_FILE):
+        return {}
+    try:
+        with open(HTTP_META_FILE, 'r', encoding='utf-8') as f:
+            http_meta = json.load(f)
+    except Exception as e:
+        print(f"读取 {HTTP_META_FILE} 失败: {e}")
+        return {}
+    if not isinstance(http_meta, dict):
+        print(f"{HTTP_META_FILE} 格式错误，已忽略")
+        return {}
+    return http_meta
+
+def save_http_meta(http_meta):
+    """保存条件请求所需的元数据"""
     try:
-        async with aiohttp.ClientSession(connector=connector, trust_env=True, headers=headers) as session:
-            async with session.get(url, timeout=30) as response:
-                response.raise_for_status()
-                return await response.text(encoding='utf-8')
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(HTTP_META_FILE, 'w', encoding='utf-8') as f:
+            json.dump(http_meta, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"写入 {HTTP_META_FILE} 失败: {e}")
+
+def prune_cache():
+    """删除长时间未使用的磁盘缓存"""
+    if not os.path.isdir(CACHE_DIR):
+        return
+    now = time.time()
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > CACHE_MAX_AGE:
+                os.remove(path)
+        except OSError as e:
+            print(f"清理缓存 {path} 失败: {e}")
+
+def _conditional_headers(http_meta, url):
+    """根据保存的元数据生成条件请求头；元数据缺失、格式错误或缓存已不存在时返回空字典"""
+    headers = {}
+    try:
+        meta = http_meta.get(url)
+        if not meta or not os.path.exists(_cache_path(bytes.fromhex(meta['hash']))):
+            return headers
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        print(f"{url} 的缓存元数据无效，发送普通请求: {e}")
+        return {}
+    return headers
+
+async def fetch_epg(session, url, http_meta, conditional=True):
+    """
+    获取EPG数据的异步函数，复用调用方传入的会话
+    上次的ETag/Last-Modified仍有对应缓存时发送条件请求，源未更新则返回NOT_MODIFIED
+    conditional 为 False 时总是发送普通请求
+    """
+    headers = _conditional_headers(http_meta, url) if conditional else {}
+    try:
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304:
+                if headers:
+                    return NOT_MODIFIED
+                # 未发送条件请求却收到304，没有可用的缓存结果
+                print(f"{url} 返回304但没有可用的缓存")
+                return None
+            response.raise_for_status()
+            epg_content = await response.read()
+            http_meta[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'hash': get_content_hash(epg_content).hex(),
+            }
+            return epg_content
     except aiohttp.ClientError as e:
         print(f"{url} HTTP请求错误: {e}")
     except asyncio.TimeoutError:
@@ -55,127 +202,259 @@ async def fetch_epg(url):
         print(f"{url} 其他错误: {e}")
     return None
 
-def parse_epg(epg_content, use_cache=True):
+def _format_xmltv_time(time_str):
+    """
+    校验XMLTV时间（YYYYmmddHHMMSS +HHMM）并按输出格式重写，不经过datetime
+    输出时区固定为 +0800，只需截取前14位数字
+    """
+    if len(time_str) < 14 or not time_str[:14].isdigit():
+        raise ValueError(f"time data '{time_str}' does not match XMLTV format")
+    return time_str[:14] + " +0800"
+
+def _parse_programme(programme, id_map):
     """
-    解析EPG内容，支持缓存
+    将单个节目节点转换为 (频道ID, Prog)，无效节目返回None
+    标题和描述保留原文，由 _convert_programmes 统一转换
     """
-    if epg_content is None or epg_content.strip() == "":
+    raw_channel_id = programme.get('channel')
+    channel_id = id_map.get(raw_channel_id)
+    if channel_id is None:
+        channel_id = transform2_zh_hans(_clean_text(raw_channel_id))
+    if not channel_id:
+        return None
+        
+    start_time = programme.get('start')
+    stop_time = programme.get('stop')
+    if not start_time or not stop_time:
+        return None
+        
+    try:
+        # 清理时间字符串中的空格
+        start_time_clean = start_time.translate(_WS)
+        stop_time_clean = stop_time.translate(_WS)
+        
+        channel_start = _format_xmltv_time(start_time_clean)
+        channel_stop = _format_xmltv_time(stop_time_clean)
+    except ValueError as e:
+        print(f"时间格式错误: {e}, 跳过该节目")
+        return None
+
+    title_elem = programme.find('title')
+    if title_elem is None or title_elem.text is None:
+        return None
+        
+    channel_title = _clean_text(title_elem.text)
+
+    # 处理描述信息
+    desc_elem = programme.find('desc')
+    channel_desc = None
+    if desc_elem is not None and desc_elem.text is not None:
+        channel_desc = _clean_text(desc_elem.text)
+
+    return channel_id, Prog(channel_start, channel_stop, channel_title, channel_desc)
+
+def convert_texts(texts, workers=1):
+    """
+    批量简繁体转换，返回 原文 -> 转换结果 的字典
+    数量较多且 workers 大于1时用最多 workers 个进程并行转换
+    """
+    texts = list(texts)
+    if workers <= 1 or len(texts) < PARALLEL_CONVERT_THRESHOLD:
+        return {text: transform2_zh_hans(text) for text in texts}
+    with multiprocessing.Pool(workers) as pool:
+        converted = pool.map(transform2_zh_hans, texts, chunksize=1024)
+    return dict(zip(texts, converted))
+
+def _convert_programmes(programmes, workers):
+    """对一个EPG源内去重后的标题和描述统一做简繁体转换"""
+    texts = set()
+    for _, prog in programmes:
+        texts.add(prog.title)
+        if prog.desc is not None:
+            texts.add(prog.desc)
+
+    converted = convert_texts(texts, workers)
+    programmes[:] = [
+        (channel_id, Prog(prog.start, prog.stop, converted[prog.title], converted.get(prog.desc)))
+        for channel_id, prog in programmes
+    ]
+
+def parse_epg(epg_content, use_cache=True, convert_workers=1):
+    """
+    解析EPG内容（原始字节），支持缓存
+    convert_workers 为大批量简繁体转换时可额外使用的进程数
+    """
+    if epg_content is None or not epg_content.strip():
         print("EPG内容为空，跳过解析")
-        return {}, defaultdict(list)
+        return {}, []
 
     # 缓存检查
     content_hash = get_content_hash(epg_content)
     if use_cache and content_hash in epg_cache:
         print("命中缓存，直接返回缓存结果")
         return epg_cache[content_hash]
+    if use_cache:
+        cached = load_cached_parse(content_hash)
+        if cached is not None:
+            print("命中磁盘缓存，直接返回缓存结果")
+            epg_cache[content_hash] = cached
+            return cached
 
     channels = {}
-    programmes = defaultdict(list)
+    # 节目按 (频道ID, Prog) 顺序平铺保存，写入时再统一按频道分组
+    programmes = []
+    # 原始频道ID -> 转换后的频道ID，节目直接查表而不再逐条转换
+    id_map = {}
 
-    try:
-        parser = ET.XMLParser(encoding='UTF-8')
-        root = ET.fromstring(epg_content, parser=parser)
-    except ET.ParseError as e:
-        print(f"Error parsing XML: {e}")
-        print(f"Problematic content: {epg_content[:500]}")  
-        return {}, defaultdict(list)
-
-    # 处理频道信息
-    for channel in root.findall('channel'):
-        channel_id = transform2_zh_hans(channel.get('id'))
-        if channel_id:
-            display_name_elem = channel.find('display-name')
-            display_name = transform2_zh_hans(display_name_elem.text if display_name_elem is not None else '')
-            channels[channel_id] = display_name
-
-    # 处理节目信息
-    for programme in root.findall('programme'):
-        channel_id = transform2_zh_hans(programme.get('channel'))
-        if not channel_id:
-            continue
-            
-        start_time = programme.get('start')
-        stop_time = programme.get('stop')
-        if not start_time or not stop_time:
-            continue
-            
-        try:
-            # 清理时间字符串中的空格
-            start_time_clean = re.sub(r'\s+', '', start_time)
-            stop_time_clean = re.sub(r'\s+', '', stop_time)
-            
-            channel_start = datetime.strptime(start_time_clean, "%Y%m%d%H%M%S%z")
-            channel_stop = datetime.strptime(stop_time_clean, "%Y%m%d%H%M%S%z")
-        except ValueError as e:
-            print(f"时间格式错误: {e}, 跳过该节目")
-            continue
-
-        title_elem = programme.find('title')
-        if title_elem is None or title_elem.text is None:
-            continue
-            
-        channel_title = transform2_zh_hans(title_elem.text)
+    # recover 让单个损坏的源不会中断整个解析；不访问网络，同时丢弃缩进空白
+    context = etree.iterparse(
+        io.BytesIO(epg_content),
+        events=('end',),
+        tag=('channel', 'programme'),
+        huge_tree=True,
+        recover=True,
+        no_network=True,
+        remove_blank_text=True,
+    )
 
-        # 创建新的节目元素
-        programme_elem = ET.Element('programme')
-        programme_elem.set("channel", channel_id)
-        programme_elem.set("start", channel_start.strftime("%Y%m%d%H%M%S +0800"))
-        programme_elem.set("stop", channel_stop.strftime("%Y%m%d%H%M%S +0800"))
-        
-        title_elem_new = ET.SubElement(programme_elem, 'title')
-        title_elem_new.text = channel_title
+    try:
+        for _, elem in context:
+            if elem.tag == 'channel':
+                # 处理频道信息
+                raw_channel_id = elem.get('id')
+                channel_id = transform2_zh_hans(_clean_text(raw_channel_id))
+                if channel_id:
+                    id_map[raw_channel_id] = channel_id
+                    display_name_elem = elem.find('display-name')
+                    display_name = transform2_zh_hans(_clean_text(display_name_elem.text) if display_name_elem is not None else '')
+                    channels[channel_id] = display_name
+            else:
+                # 处理节目信息
+                parsed = _parse_programme(elem, id_map)
+                if parsed is not None:
+                    programmes.append(parsed)
 
-        # 处理描述信息
-        desc_elem = programme.find('desc')
-        if desc_elem is not None and desc_elem.text is not None:
-            channel_desc = transform2_zh_hans(desc_elem.text)
-            desc_elem_new = ET.SubElement(programme_elem, 'desc')
-            desc_elem_new.text = channel_desc
+            # 释放已处理的节点，保持内存占用稳定
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+    except etree.XMLSyntaxError as e:
+        print(f"Error parsing XML: {e}")
+        print(f"Problematic content: {epg_content[:500].decode('utf-8', errors='replace')}")  
+        return {}, []
 
-        programmes[channel_id].append(programme_elem)
+    _convert_programmes(programmes, convert_workers)
 
     # 缓存结果
     if use_cache:
         epg_cache[content_hash] = (channels, programmes)
+        save_cached_parse(content_hash, (channels, programmes))
         print("解析结果已缓存")
 
     return channels, programmes
 
-def write_to_xml(channels, programmes, filename):
-    """写入XML文件"""
+class _XmltvWriter:
+    """向单个输出文件流式写入XMLTV元素，pretty 为 False 时输出紧凑XML"""
+    def __init__(self, xf, pretty):
+        self.xf = xf
+        self.pretty = pretty
+
+    def ws(self, text):
+        """仅在需要美化输出时写入缩进和换行"""
+        if self.pretty:
+            self.xf.write(text)
+
+    def write_channel(self, channel_id, display_name):
+        xf = self.xf
+        self.ws('\t')
+        with xf.element('channel', id=channel_id):
+            self.ws('\n\t\t')
+            with xf.element('display-name', lang='zh'):
+                xf.write(display_name)
+            self.ws('\n\t')
+        self.ws('\n')
+
+    def write_programme(self, channel_id, prog):
+        xf = self.xf
+        self.ws('\t')
+        with xf.element('programme', channel=channel_id, start=prog.start, stop=prog.stop):
+            self.ws('\n\t\t')
+            with xf.element('title'):
+                xf.write(prog.title)
+            if prog.desc is not None:
+                self.ws('\n\t\t')
+                with xf.element('desc'):
+                    xf.write(prog.desc)
+            self.ws('\n\t')
+        self.ws('\n')
+
+def _drain(items):
+    """从列表尾部依次取出并产出元素，产出后列表不再持有该元素"""
+    while items:
+        yield items.pop()
+
+def write_to_xml(channels, per_feed_programmes, outputs):
+    """
+    一次遍历流式写入所有输出文件，outputs 为 (文件名, 是否美化) 列表，文件名以.gz结尾时直接写出gz压缩文件
+    per_feed_programmes 为各EPG源解析出的 (频道ID, Prog) 列表，各自按频道ID稳定排序后归并，再按频道分组写出
+    节目写出后即从各源列表中移除，峰值内存不会因写入而翻倍
+    多个源中同一频道、同一时段的节目只保留排在前面的源
+    """
     if not os.path.exists('output'):
         os.makedirs('output')
         
     current_time = datetime.now().strftime("%Y%m%d%H%M%S +0800")
-    root = ET.Element('tv', attrib={'date': current_time})
-    
-    # 添加频道信息
-    for channel_id, display_name in channels.items():
-        channel_elem = ET.SubElement(root, 'channel', attrib={"id": channel_id})
-        display_name_elem = ET.SubElement(channel_elem, 'display-name', attrib={"lang": "zh"})
-        display_name_elem.text = display_name
-    
-    # 添加节目信息
-    for channel_id, prog_list in programmes.items():
-        for prog in prog_list:
-            prog.set('channel', channel_id)
-            root.append(prog)
-
-    # Beautify the XML output
-    rough_string = ET.tostring(root, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write(reparsed.toprettyxml(indent='\t', newl='\n'))
-
-def compress_to_gz(input_filename, output_filename):
-    """压缩文件为gz格式"""
+
+    # 稳定排序保证同一频道内仍保持源的先后顺序；反转后可从列表尾部依次取出
+    for feed in per_feed_programmes:
+        feed.sort(key=itemgetter(0))
+        feed.reverse()
+
+    # 先写入临时文件，全部成功后再替换正式文件，避免失败时留下被截断的输出
+    tmp_files = [(f"{filename}.tmp", filename) for filename, _ in outputs]
     try:
-        with open(input_filename, 'rb') as f_in:
-            with gzip.open(output_filename, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        print(f"文件已压缩: {output_filename}")
-    except Exception as e:
-        print(f"压缩文件时出错: {e}")
+        with contextlib.ExitStack() as stack:
+            writers = []
+            for (tmp_filename, filename), (_, pretty) in zip(tmp_files, outputs):
+                f = stack.enter_context(open(tmp_filename, 'wb'))
+                if filename.endswith('.gz'):
+                    # gz头中记录正式文件名而不是临时文件名
+                    f = stack.enter_context(gzip.GzipFile(filename=filename, mode='wb', fileobj=f))
+                xf = stack.enter_context(etree.xmlfile(f, encoding='utf-8'))
+                xf.write_declaration()
+                stack.enter_context(xf.element('tv', date=current_time))
+                writer = _XmltvWriter(xf, pretty)
+                writer.ws('\n')
+                writers.append(writer)
+
+            # 添加频道信息（XMLTV要求所有频道位于节目之前）
+            for channel_id, display_name in channels.items():
+                for writer in writers:
+                    writer.write_channel(channel_id, display_name)
+
+            # 按频道添加节目信息
+            merged = heapq.merge(*map(_drain, per_feed_programmes), key=itemgetter(0))
+            for channel_id, group in itertools.groupby(merged, key=itemgetter(0)):
+                seen = set()
+                for _, prog in group:
+                    # 跳过镜像源中重复的节目
+                    key = (prog.start, prog.stop)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    for writer in writers:
+                        writer.write_programme(channel_id, prog)
+    except BaseException:
+        for tmp_filename, _ in tmp_files:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+        raise
+
+    for tmp_filename, filename in tmp_files:
+        os.replace(tmp_filename, filename)
+
+    for filename, _ in outputs:
+        print(f"文件已写入: {filename}")
 
 def get_urls():
     """获取URL列表，增加文件存在检查"""
@@ -195,6 +474,32 @@ def get_urls():
         
     return urls
 
+async def fetch_and_parse(session, pool, convert_workers, http_meta, i, url):
+    """下载单个EPG源并在进程池中解析，失败时返回None"""
+    loop = asyncio.get_running_loop()
+    epg_content = await fetch_epg(session, url, http_meta)
+    if epg_content is NOT_MODIFIED:
+        print(f"URL {i+1} 未更新，使用缓存结果")
+        content_hash = bytes.fromhex(http_meta[url]['hash'])
+        cached = await loop.run_in_executor(None, load_cached_parse, content_hash)
+        if cached is not None:
+            return cached
+        # 缓存已损坏并被删除，丢弃元数据后重新完整下载
+        print(f"URL {i+1} 缓存结果读取失败，重新下载")
+        http_meta.pop(url, None)
+        epg_content = await fetch_epg(session, url, http_meta, conditional=False)
+
+    if epg_content is None:
+        print(f"URL {i+1} 返回空内容")
+        return None
+
+    try:
+        parse = functools.partial(parse_epg, convert_workers=convert_workers)
+        return await loop.run_in_executor(pool, parse, epg_content)
+    except Exception as e:
+        print(f"解析 URL {i+1} 时出错: {e}")
+        return None
+
 async def main():
     try:
         urls = get_urls()
@@ -204,34 +509,40 @@ async def main():
             
         print(f"找到 {len(urls)} 个EPG数据源")
         
-        # 创建任务列表
-        tasks = [fetch_epg(url) for url in urls]
-        print("Fetching EPG data...")
-        
-        # 使用tqdm_asyncio.gather并发执行任务
-        epg_contents = await tqdm_asyncio.gather(*tasks, desc="Fetching URLs")
-        
         all_channels = {}
-        all_programmes = defaultdict(list)
-        
-        print("Parsing EPG data...")
+        per_feed_programmes = []
         successful_parses = 0
-        
-        # 使用tqdm显示解析进度
-        for i, epg_content in enumerate(tqdm(epg_contents, desc="Parsing EPG")):
-            if epg_content is None:
-                print(f"URL {i+1} 返回空内容")
-                continue
+        http_meta = load_http_meta()
+
+        # 所有源共用一个会话，复用连接和DNS缓存；每个源下载完成后立即交给进程池解析
+        connector = aiohttp.TCPConnector(limit=16, ttl_dns_cache=300, ssl=False)
+        timeout = aiohttp.ClientTimeout(total=30)
+        # 事件循环启动后存在aiohttp解析线程等其他线程，支持时用forkserver创建子进程，避免fork多线程进程导致死锁
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context('forkserver')
+        else:
+            mp_context = multiprocessing.get_context()
+        # 各源已在进程池中并行解析，单个源内的并行转换按源数量分摊CPU，避免进程数膨胀
+        convert_workers = max(1, (os.cpu_count() or 1) // len(urls))
+        with concurrent.futures.ProcessPoolExecutor(mp_context=mp_context) as pool:
+            async with aiohttp.ClientSession(connector=connector, trust_env=True, headers=HEADERS, timeout=timeout) as session:
+                # 创建任务列表
+                tasks = [fetch_and_parse(session, pool, convert_workers, http_meta, i, url) for i, url in enumerate(urls)]
+                print("Fetching and parsing EPG data...")
                 
-            try:
-                channels, programmes = parse_epg(epg_content)
-                if channels:
-                    all_channels.update(channels)
-                    for channel_id, prog_list in programmes.items():
-                        all_programmes[channel_id].extend(prog_list)
-                    successful_parses += 1
-            except Exception as e:
-                print(f"解析 URL {i+1} 时出错: {e}")
+                # 使用tqdm_asyncio.gather并发执行任务，结果顺序与URL顺序一致
+                results = await tqdm_asyncio.gather(*tasks, desc="Fetching & parsing")
+        save_http_meta(http_meta)
+
+        # 按URL顺序合并，保证输出稳定
+        for result in results:
+            if result is None:
+                continue
+            channels, programmes = result
+            if channels:
+                all_channels.update(channels)
+                per_feed_programmes.append(programmes)
+                successful_parses += 1
         
         print(f"成功解析 {successful_parses}/{len(urls)} 个EPG源")
         
@@ -239,12 +550,10 @@ async def main():
             print("没有成功解析到任何频道信息，程序退出")
             return
             
-        print("Writing to XML...")
-        write_to_xml(all_channels, all_programmes, 'output/epg.xml')
-        
-        print("Compressing to gz...")
-        compress_to_gz('output/epg.xml', 'output/epg.gz')
+        print("Writing to XML and gz...")
+        write_to_xml(all_channels, per_feed_programmes, [('output/epg.gz', False), ('output/epg.xml', True)])
         
+        prune_cache()
         print("EPG生成完成！")
         
     except Exception as e: